@@ -3,10 +3,18 @@ import io
 import base64
 import pandas as pd
 import json
-from datetime import datetime
+import hashlib
+from datetime import datetime, timedelta
+from PIL import Image
 
 # Import Google Cloud Storage client
 from google.cloud import storage
+from google.cloud.exceptions import NotFound, PreconditionFailed
+from google.oauth2 import service_account
+from google.auth.transport.requests import AuthorizedSession
+from requests.adapters import HTTPAdapter
+
+gcs_http_pool_size = 20 # Kept-alive connections to GCS, shared by every session using the cached client
 
 # --- GCS Client Initialization ---
 @st.cache_resource
@@ -14,7 +22,14 @@ def get_gcs_client():
     try:
         # Load credentials from st.secrets
         key_dict = json.loads(st.secrets["gcs_credentials"])
-        client = storage.Client.from_service_account_info(key_dict)
+        credentials = service_account.Credentials.from_service_account_info(key_dict, scopes=storage.Client.SCOPE)
+
+        # The client is shared across sessions, so give its HTTP session a pool large enough
+        # that concurrent saves/deletes reuse warm TLS connections instead of opening new ones
+        http = AuthorizedSession(credentials)
+        http.mount("https://", HTTPAdapter(pool_connections=gcs_http_pool_size, pool_maxsize=gcs_http_pool_size))
+
+        client = storage.Client(project=key_dict.get("project_id"), credentials=credentials, _http=http)
         st.success("Connected to Google Cloud Storage!")
         return client
     except Exception as e:
@@ -23,55 +38,268 @@ def get_gcs_client():
 
 gcs_client = get_gcs_client()
 gcs_bucket_name = st.secrets.get("gcs_bucket_name")
-gcs_csv_filename = "images_data.csv" # The name of the CSV file in your GCS bucket
+gcs_manifest_filename = "images_manifest.csv" # Small CSV listing the images stored in your GCS bucket
+gcs_legacy_csv_filename = "images_data.csv" # Older CSV holding every image as Base64; migrated once and kept
+images_per_page = 10 # Only this many pictures are rendered per rerun
+thumbnail_size = (256, 256) # Bounding box for the list-view copy of each picture
+manifest_write_attempts = 3 # Re-read and retry when another session wrote the manifest first
+
+# Build the bucket handle once; client.bucket() makes no API call, unlike get_bucket()
+gcs_bucket = gcs_client.bucket(gcs_bucket_name) if gcs_client and gcs_bucket_name else None
 
-# --- Functions for GCS CSV Operations ---
+# --- Functions for GCS Operations ---
 
-def load_images_from_gcs_csv(client, bucket_name, filename):
-    """Loads image data from a CSV file in GCS into a DataFrame."""
-    if not client or not bucket_name:
-        return pd.DataFrame(columns=['id', 'timestamp', 'image_b64'])
+def load_manifest_from_gcs(bucket, filename, legacy_filename, user_id):
+    """Loads the image manifest (id, timestamp, gcs_path, thumb_path) from a CSV file in GCS into a list of dicts.
+
+    If there is no manifest yet but the older Base64 CSV exists, it is migrated first.
+    """
+    if not bucket:
+        return []
 
     try:
-        bucket = client.get_bucket(bucket_name)
-        blob = bucket.blob(filename)
-        
-        if blob.exists():
-            csv_bytes = blob.download_as_bytes()
-            df = pd.read_csv(io.BytesIO(csv_bytes))
-            st.info(f"Loaded {len(df)} images from GCS.")
-            return df
+        images, generation = read_manifest_from_gcs(bucket, filename)
+
+        if generation:
+            st.info(f"Loaded {len(images)} images from GCS.")
+            return images
+        elif bucket.blob(legacy_filename).exists():
+            try:
+                return migrate_legacy_csv_to_gcs(bucket, legacy_filename, filename, user_id)
+            except Exception as e:
+                st.error(
+                    f"Error migrating pictures from {legacy_filename}: {e}. "
+                    "Saving is disabled until the migration succeeds; reload the page to retry."
+                )
+                return []
         else:
-            st.info("No existing image data CSV found in GCS. Starting fresh.")
-            return pd.DataFrame(columns=['id', 'timestamp', 'image_b64'])
+            st.info("No existing image manifest found in GCS. Starting fresh.")
+            return []
     except Exception as e:
-        st.error(f"Error loading images from GCS CSV: {e}")
-        return pd.DataFrame(columns=['id', 'timestamp', 'image_b64'])
+        st.error(f"Error loading image manifest from GCS: {e}")
+        return []
+
+def read_manifest_from_gcs(bucket, filename):
+    """Returns the manifest rows and the object generation they were read at (0 if there is no manifest yet)."""
+    blob = bucket.get_blob(filename)
+    if blob is None:
+        return [], 0
+
+    csv_bytes = blob.download_as_bytes(if_generation_match=blob.generation)
+    df = pd.read_csv(io.BytesIO(csv_bytes), dtype=str, keep_default_na=False)
+    return df.to_dict(orient='records'), blob.generation
+
+def save_manifest_to_gcs(bucket, filename, images, generation):
+    """Writes the list of image dicts to the manifest CSV file in GCS.
+
+    The write only succeeds if the manifest is still at `generation` (0 means it must not exist yet);
+    otherwise PreconditionFailed is raised and nothing is overwritten.
+    """
+    # Build the DataFrame only here; session state keeps a plain list so saves append in O(1)
+    dataframe = pd.DataFrame(images, columns=['id', 'timestamp', 'gcs_path', 'thumb_path'])
+
+    # to_csv() with no buffer already returns the string, so skip the StringIO copy
+    bucket.blob(filename).upload_from_string(
+        dataframe.to_csv(index=False), content_type='text/csv', if_generation_match=generation
+    )
+
+def update_manifest_in_gcs(bucket, filename, legacy_filename, change):
+    """Applies change(images) to the latest stored manifest and writes the result back.
 
-def save_images_to_gcs_csv(client, bucket_name, filename, dataframe):
-    """Saves DataFrame containing image data to a CSV file in GCS."""
-    if not client or not bucket_name:
+    Every session shares the manifest, so it is re-read before each change instead of trusting
+    this session's copy, and the write is retried if another session wrote it in between.
+    While the older Base64 CSV has not been migrated, no manifest is created, so a failed
+    migration can never be replaced by a manifest that leaves the old pictures out.
+    Returns the updated list of image dicts, or None if the manifest could not be updated.
+    """
+    if not bucket:
         st.error("GCS client or bucket name not available. Cannot save.")
-        return False
+        return None
 
     try:
-        bucket = client.get_bucket(bucket_name)
-        blob = bucket.blob(filename)
-        
-        csv_buffer = io.StringIO()
-        dataframe.to_csv(csv_buffer, index=False)
-        blob.upload_from_string(csv_buffer.getvalue(), content_type='text/csv')
-        st.success("Image data saved persistently to GCS CSV!")
-        return True
+        for _ in range(manifest_write_attempts):
+            images, generation = read_manifest_from_gcs(bucket, filename)
+            if not generation and bucket.blob(legacy_filename).exists():
+                st.error(
+                    f"Pictures in {legacy_filename} have not been migrated yet, so nothing can be saved. "
+                    "Reload the page to retry the migration."
+                )
+                return None
+
+            new_images = change(images)
+            try:
+                save_manifest_to_gcs(bucket, filename, new_images, generation)
+            except PreconditionFailed:
+                continue # Another session changed the manifest; re-read and apply the change again
+            st.success("Image data saved persistently to GCS!")
+            return new_images
+        st.error("The image list is being changed by another session. Please try again.")
     except Exception as e:
-        st.error(f"Error saving images to GCS CSV: {e}")
-        return False
+        st.error(f"Error saving image manifest to GCS: {e}")
+    return None
+
+def upload_image_to_gcs(bucket, gcs_path, image_bytes):
+    """Uploads the raw image bytes to their own object in GCS, skipping objects that already exist."""
+    blob = bucket.blob(gcs_path)
+    if not blob.exists():
+        blob.upload_from_string(image_bytes, content_type='image/jpeg')
+
+def upload_thumbnail_to_gcs(bucket, thumb_path, image_bytes):
+    """Uploads a thumbnail of the image, only generating it when the object does not exist yet."""
+    blob = bucket.blob(thumb_path)
+    if not blob.exists():
+        blob.upload_from_string(make_thumbnail(image_bytes), content_type='image/jpeg')
+
+def delete_image_from_gcs(bucket, gcs_path):
+    """Deletes an image object from GCS, ignoring objects that are already gone."""
+    try:
+        bucket.blob(gcs_path).delete()
+    except NotFound:
+        pass
+
+def make_thumbnail(image_bytes):
+    """Returns a small JPEG copy of the image for the list view."""
+    image = Image.open(io.BytesIO(image_bytes))
+    image.thumbnail(thumbnail_size)
+    buffer = io.BytesIO()
+    image.convert('RGB').save(buffer, format='JPEG', quality=80)
+    return buffer.getvalue()
+
+def migrate_legacy_csv_to_gcs(bucket, legacy_filename, manifest_filename, user_id):
+    """Moves images from the older Base64 CSV into per-image objects and writes the manifest.
+
+    Rows that cannot be decoded are skipped and reported. Any other failure raises before the
+    manifest is written, and update_manifest_in_gcs refuses to create a manifest while the old CSV
+    is unmigrated, so the old CSV (which is left in place) is migrated again next session.
+    """
+    csv_bytes = bucket.blob(legacy_filename).download_as_bytes()
+    legacy_df = pd.read_csv(io.BytesIO(csv_bytes), dtype=str, keep_default_na=False)
+
+    images = []
+    migrated_paths = set()
+    skipped_ids = []
+    for row in legacy_df.to_dict(orient='records'):
+        try:
+            # Everything in here is local, so a failure means the row itself is bad, not GCS.
+            # Building the thumbnail doubles as the check that the bytes decode as an image.
+            datetime.fromisoformat(row['timestamp'])
+            image_bytes = base64.b64decode(row['image_b64'], validate=True)
+            thumb_bytes = make_thumbnail(image_bytes)
+        except Exception:
+            skipped_ids.append(row['id'])
+            continue
+
+        digest = hashlib.sha256(image_bytes).hexdigest()
+        gcs_path = f"{user_id}/{digest}.jpg"
+        if gcs_path in migrated_paths:
+            continue # Same picture saved twice; each object is listed only once
+
+        thumb_path = f"{user_id}/{digest}_thumb.jpg"
+        upload_image_to_gcs(bucket, gcs_path, image_bytes)
+        upload_image_to_gcs(bucket, thumb_path, thumb_bytes)
+        migrated_paths.add(gcs_path)
+        images.append({
+            'id': row['id'],
+            'timestamp': row['timestamp'],
+            'gcs_path': gcs_path,
+            'thumb_path': thumb_path
+        })
+
+    try:
+        save_manifest_to_gcs(bucket, manifest_filename, images, 0)
+    except PreconditionFailed:
+        # Another session finished the same migration first; use the manifest it wrote
+        return read_manifest_from_gcs(bucket, manifest_filename)[0]
+    st.info(f"Migrated {len(images)} images from {legacy_filename} to per-image storage.")
+    if skipped_ids:
+        st.warning(
+            f"Skipped {len(skipped_ids)} unreadable pictures in {legacy_filename} (ids: {', '.join(skipped_ids)}). "
+            "The file itself is left unchanged."
+        )
+    return images
+
+@st.cache_data(ttl=3000)
+def get_image_url(_bucket, gcs_path):
+    """Returns a signed URL so the browser fetches the image directly from GCS.
+
+    Cached for less than the URL lifetime so reruns reuse the same URL and the browser cache.
+    """
+    return _bucket.blob(gcs_path).generate_signed_url(version="v4", expiration=timedelta(hours=1), method="GET")
+
+def save_picture(bucket, manifest_filename, legacy_filename, user_id, image_file):
+    """Save button callback; runs before the rerun, so the gallery is drawn with the new picture."""
+    if not bucket:
+        st.warning("GCS client or bucket not available. Cannot save image.")
+        return
+
+    try:
+        # Read image bytes
+        image_bytes = image_file.getvalue()
+
+        # Name the object by content hash so identical captures map to the same object
+        digest = hashlib.sha256(image_bytes).hexdigest()
+        gcs_path = f"{user_id}/{digest}.jpg"
+        thumb_path = f"{user_id}/{digest}_thumb.jpg"
+
+        if any(x['gcs_path'] == gcs_path for x in st.session_state.images_list):
+            st.info("This picture is already saved.")
+            return
+
+        # Upload only this image; the manifest rewrite below is just a few bytes per row
+        upload_image_to_gcs(bucket, gcs_path, image_bytes)
+        upload_thumbnail_to_gcs(bucket, thumb_path, image_bytes)
+
+        new_image = {
+            'id': str(datetime.now().timestamp()), # Unique ID for this image
+            'timestamp': datetime.now().isoformat(),
+            'gcs_path': gcs_path,
+            'thumb_path': thumb_path
+        }
+
+        # Add the row to the latest stored manifest (another session may already have saved
+        # this picture); session state only changes once it is stored, so a failed write
+        # can be retried instead of being reported as already saved
+        new_images_list = update_manifest_in_gcs(
+            bucket, manifest_filename, legacy_filename,
+            lambda images: images if any(x['gcs_path'] == gcs_path for x in images) else images + [new_image]
+        )
+        if new_images_list is not None:
+            st.session_state.images_list = new_images_list
+    except Exception as e:
+        st.error(f"Error processing image for saving: {e}")
+
+def delete_picture(bucket, manifest_filename, legacy_filename, img_data):
+    """Delete button callback; runs before the rerun, so the gallery is drawn without the picture."""
+    if not bucket:
+        st.warning("GCS client or bucket not available. Cannot delete.")
+        return
+
+    try:
+        # Update the manifest first; an orphaned object is harmless, but a manifest
+        # row pointing at a deleted object would render as a broken image
+        remaining_images = update_manifest_in_gcs(
+            bucket, manifest_filename, legacy_filename, lambda images: [x for x in images if x['id'] != img_data['id']]
+        )
+        if remaining_images is not None:
+            st.session_state.images_list = remaining_images
+
+            # Another session may have saved the same picture again in the meantime
+            if all(x['gcs_path'] != img_data['gcs_path'] for x in remaining_images):
+                delete_image_from_gcs(bucket, img_data['gcs_path'])
+                if img_data.get('thumb_path'):
+                    delete_image_from_gcs(bucket, img_data['thumb_path'])
+    except Exception as e:
+        st.error(f"Error processing deletion: {e}")
+
+def go_to_page(page):
+    """Prev/Next button callback; sets the gallery page before the rerun draws it."""
+    st.session_state.page = page
 
 # --- App Title and Description ---
 st.set_page_config(layout="centered")
 
-st.title("Live Camera Image Storage (Permanent with GCS CSV)")
-st.write("Capture photos from your webcam and store their Base64 data permanently in a CSV file on Google Cloud Storage.")
+st.title("Live Camera Image Storage (Permanent with GCS)")
+st.write("Capture photos from your webcam and store them permanently on Google Cloud Storage.")
 
 # --- User ID Display (Conceptual for multi-user) ---
 # For a multi-user app, you would manage user authentication and assign unique IDs.
@@ -83,9 +311,11 @@ st.markdown(f"Your User ID for Storage: `{st.session_state.user_id}`")
 st.markdown("---")
 
 # --- Load images at the start of the app ---
-# This will load the CSV data from GCS into session state for display and modification
-if 'current_images_df' not in st.session_state:
-    st.session_state.current_images_df = load_images_from_gcs_csv(gcs_client, gcs_bucket_name, gcs_csv_filename)
+# This will load the manifest from GCS into session state for display and modification
+if 'images_list' not in st.session_state:
+    st.session_state.images_list = load_manifest_from_gcs(
+        gcs_bucket, gcs_manifest_filename, gcs_legacy_csv_filename, st.session_state.user_id
+    )
 
 # --- Camera Input Section ---
 st.header("Capture a Photo")
@@ -94,66 +324,44 @@ captured_image_file = st.camera_input("Take a picture")
 if captured_image_file:
     st.image(captured_image_file, caption="Captured Image Preview", use_column_width=True)
 
-    if st.button("Save Image to GCS CSV"):
-        if gcs_client and gcs_bucket_name:
-            try:
-                # Read image bytes
-                image_bytes = captured_image_file.getvalue()
-
-                # Convert to Base64 for storage in CSV
-                base64_image = base64.b64encode(image_bytes).decode('utf-8')
-
-                # Create a new row for the DataFrame
-                new_image_entry = pd.DataFrame([{
-                    'id': str(datetime.now().timestamp()), # Unique ID for this image
-                    'timestamp': datetime.now().isoformat(),
-                    'image_b64': base64_image
-                }])
-
-                # Append to the current DataFrame in session state
-                st.session_state.current_images_df = pd.concat([st.session_state.current_images_df, new_image_entry], ignore_index=True)
-                
-                # Save the updated DataFrame back to GCS
-                if save_images_to_gcs_csv(gcs_client, gcs_bucket_name, gcs_csv_filename, st.session_state.current_images_df):
-                    st.experimental_rerun() # Rerun to display updated list from GCS
-                
-            except Exception as e:
-                st.error(f"Error processing image for saving: {e}")
-        else:
-            st.warning("GCS client or bucket not available. Cannot save image.")
+    st.button(
+        "Save Image to GCS", on_click=save_picture,
+        args=(gcs_bucket, gcs_manifest_filename, gcs_legacy_csv_filename, st.session_state.user_id, captured_image_file)
+    )
 
 st.markdown("---")
 
-# --- Display Saved Pictures from GCS CSV ---
+# --- Display Saved Pictures from GCS ---
 st.header("My Saved Pictures (from GCS)")
 
-if not st.session_state.current_images_df.empty:
-    # Display images in reverse order (most recent first)
-    images_to_display = st.session_state.current_images_df.to_dict(orient='records')
+if st.session_state.images_list:
+    # Display images in reverse order (most recent first), one page at a time
+    images_to_display = st.session_state.images_list[::-1]
+    page_count = (len(images_to_display) + images_per_page - 1) // images_per_page
+    page = min(st.session_state.get('page', 0), page_count - 1) # Clamp after deletes
+    st.session_state.page = page
+    start = page * images_per_page
 
-    for i, img_data in enumerate(reversed(images_to_display)):
+    for i, img_data in enumerate(images_to_display[start:start + images_per_page], start=start):
         st.subheader(f"Picture taken on: {datetime.fromisoformat(img_data['timestamp']).strftime('%Y-%m-%d %H:%M:%S')}")
-        
-        # Decode Base64 string back to bytes for st.image
-        image_bytes = base64.b64decode(img_data['image_b64'])
-        st.image(image_bytes, use_column_width=True)
-
-        if st.button(f"Delete Picture {i+1}", key=f"delete_gcs_{img_data['id']}"):
-            if gcs_client and gcs_bucket_name:
-                try:
-                    # Remove the row from the DataFrame
-                    st.session_state.current_images_df = st.session_state.current_images_df[
-                        st.session_state.current_images_df['id'] != img_data['id']
-                    ].reset_index(drop=True)
-
-                    # Save the updated DataFrame back to GCS
-                    if save_images_to_gcs_csv(gcs_client, gcs_bucket_name, gcs_csv_filename, st.session_state.current_images_df):
-                        st.experimental_rerun() # Rerun to update the display
-                except Exception as e:
-                    st.error(f"Error processing deletion: {e}")
+
+        if gcs_bucket:
+            # List view shows the thumbnail; the full image is only fetched when expanded.
+            # Images saved before thumbnails existed have no thumb_path and show in full.
+            thumb_path = img_data.get('thumb_path')
+            if thumb_path and not st.checkbox("Show full size", key=f"expand_gcs_{img_data['id']}"):
+                st.image(get_image_url(gcs_bucket, thumb_path)) # Shown at its own size, never upscaled
             else:
-                st.warning("GCS client or bucket not available. Cannot delete.")
+                st.image(get_image_url(gcs_bucket, img_data['gcs_path']), use_column_width=True)
+
+        st.button(f"Delete Picture {i+1}", key=f"delete_gcs_{img_data['id']}", on_click=delete_picture,
+                  args=(gcs_bucket, gcs_manifest_filename, gcs_legacy_csv_filename, img_data))
         st.markdown("---")
+
+    if page_count > 1:
+        prev_col, page_col, next_col = st.columns(3)
+        prev_col.button("Prev", disabled=page == 0, on_click=go_to_page, args=(page - 1,))
+        page_col.write(f"Page {page + 1} of {page_count}")
+        next_col.button("Next", disabled=page == page_count - 1, on_click=go_to_page, args=(page + 1,))
 else:
     st.info("No pictures found in GCS for this user. Take one!")
-